@@ -1,17 +1,37 @@
 import os
 import redis
-import random
+import secrets
 import boto3
+import orjson
 import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Empty, Full, Queue
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 from dotenv import load_dotenv
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 # Load environment variables
 load_dotenv()
 
+
+class ORJSONProvider(JSONProvider):
+    """Serve Flask's JSON through orjson"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
 CORS(app)  # This allows all origins
 
 # Setup logging
@@ -20,39 +40,215 @@ logger = logging.getLogger(__name__)
 
 # Redis setup
 REDIS_URL = os.getenv("REDIS_URL")
-SESSION_KEY = "otp_session"
 
-# Redis client
+# Redis key names, pre-encoded so redis-py skips its str encoder
+OTP_PREFIX = b"otp:"
+PENDING_PREFIX = b"pending_otp:"
+VERIFIED_SET = b"verified_numbers"
+UNVERIFIED_SET = b"unverified_numbers"
+RATE_LIMIT_PREFIX = b"otp_ratelimit:"
+RATE_LIMIT_WINDOW = 30  # seconds between OTP sends per number
+
+# Redis client backed by a bounded, shared connection pool
 try:
-    redis_client: redis.Redis = redis.from_url(REDIS_URL)
+    redis_pool = redis.BlockingConnectionPool.from_url(
+        REDIS_URL,
+        max_connections=64,
+        timeout=2,
+        socket_timeout=1,
+        socket_connect_timeout=1,
+        health_check_interval=30
+    )
+    redis_client: redis.Redis = redis.Redis(connection_pool=redis_pool)
+    redis_client.ping()
     logger.info("Connected to Redis successfully")
 except Exception as ex:
     raise Exception(f"Could not connect to Redis: {str(ex)}")
 
+# Atomically compare and consume an OTP: 0 = not found, 1 = match, 2 = mismatch.
+# The byte-wise XOR keeps the comparison constant-time.
+VERIFY_OTP_LUA = redis_client.register_script("""
+local stored = redis.call('GET', KEYS[1])
+if not stored then return 0 end
+local submitted = ARGV[1]
+if #stored ~= #submitted then return 2 end
+local diff = 0
+for i = 1, #stored do
+    diff = bit.bor(diff, bit.bxor(string.byte(stored, i), string.byte(submitted, i)))
+end
+if diff ~= 0 then return 2 end
+redis.call('DEL', KEYS[1])
+return 1
+""")
+
+# Claim the per-number send slot (SET NX EX) and store the OTP only if the
+# claim succeeded, so a rate-limited request never overwrites a live OTP.
+# 1 = stored, 0 = rate limited.
+CLAIM_AND_STORE_OTP_LUA = redis_client.register_script("""
+if not redis.call('SET', KEYS[1], 1, 'NX', 'EX', ARGV[3]) then return 0 end
+redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[2])
+return 1
+""")
+
 # AWS SNS setup
 AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
+SNS_MAX_WORKERS = 32
+
+# Keep enough pooled HTTPS connections for every executor thread
+sns_config = Config(
+    max_pool_connections=max(50, SNS_MAX_WORKERS),
+    retries={'max_attempts': 2, 'mode': 'standard'},
+    tcp_keepalive=True,
+    connect_timeout=1,
+    read_timeout=3
+)
 sns_client = boto3.client(
     "sns",
     region_name=AWS_REGION,
     aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY")
+    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+    config=sns_config
 )
 
+# Shared OTP SMS payload pieces
+SMS_MESSAGE_PREFIX = "Your verification code is: "
+SMS_ATTRIBUTES = {
+    'AWS.SNS.SMS.SMSType': {
+        'DataType': 'String',
+        'StringValue': 'Transactional'
+    }
+}
+
+# Background executor so SNS publishes stay off the request path
+EXECUTOR = ThreadPoolExecutor(max_workers=SNS_MAX_WORKERS)
+
+# Optional SNS topic for batched sends. PublishBatch only works against a
+# topic, so each phone needs an SMS subscription filtered on the
+# "phone_number" message attribute; without a topic we publish directly.
+# Topic publishes can't detect sandbox-unverified numbers, so the sandbox
+# verification flow and the verified-number bookkeeping don't apply.
+SNS_TOPIC_ARN = os.getenv("SNS_TOPIC_ARN")
+SNS_BATCH_SIZE = 10  # PublishBatch limit
+SNS_BATCH_WAIT = 0.05  # seconds
+OUTBOX = Queue(maxsize=1000)
+
+# Process-local LRU of verified numbers: {phone_number: expires_at}
+VERIFIED_CACHE_TTL = 60  # seconds
+VERIFIED_CACHE_SIZE = 10000
+_verified_cache = OrderedDict()
+_verified_cache_lock = threading.Lock()
+
+
+def cache_verified(phone_number):
+    """Remember a verified number locally, evicting the least recently used"""
+    with _verified_cache_lock:
+        _verified_cache[phone_number] = time.monotonic() + VERIFIED_CACHE_TTL
+        _verified_cache.move_to_end(phone_number)
+        while len(_verified_cache) > VERIFIED_CACHE_SIZE:
+            _verified_cache.popitem(last=False)
+
 
 def is_number_verified(phone_number):
-    """Check if phone number is verified (stored in Redis)"""
-    return redis_client.sismember("verified_numbers", phone_number)
+    """Check if phone number is verified (cached locally, backed by Redis)"""
+    with _verified_cache_lock:
+        expires_at = _verified_cache.get(phone_number)
+        if expires_at is not None:
+            if time.monotonic() < expires_at:
+                _verified_cache.move_to_end(phone_number)
+                return True
+            del _verified_cache[phone_number]
+
+    verified = redis_client.sismember(VERIFIED_SET, phone_number)
+    if verified:
+        cache_verified(phone_number)
+    return verified
 
 
 def mark_number_as_verified(phone_number):
     """Mark a phone number as verified"""
-    redis_client.sadd("verified_numbers", phone_number)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.sadd(VERIFIED_SET, phone_number)
+    pipe.srem(UNVERIFIED_SET, phone_number)
+    pipe.execute()
+    cache_verified(phone_number)
+
+
+def is_number_unverified(phone_number):
+    """Check if SNS has rejected this number as unverified in the sandbox"""
+    return redis_client.sismember(UNVERIFIED_SET, phone_number)
+
+
+def mark_number_as_unverified(phone_number):
+    """Remember that a phone number still needs sandbox verification"""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.sadd(UNVERIFIED_SET, phone_number)
+    pipe.srem(VERIFIED_SET, phone_number)
+    pipe.execute()
+    with _verified_cache_lock:
+        _verified_cache.pop(phone_number, None)
+
+
+def get_request_json():
+    """Parse the request body straight from bytes; invalid JSON reads as empty"""
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def normalize_phone(phone_number):
+    """Ensure phone number has +91 prefix"""
+    phone_number = phone_number.strip()
+    if phone_number.startswith('+91'):
+        return phone_number
+    return '+91' + phone_number.lstrip('0')
+
+
+def otp_key(phone_number):
+    """Redis key holding the active OTP for a phone number"""
+    return OTP_PREFIX + phone_number.encode()
+
+
+def pending_otp_key(phone_number):
+    """Redis key holding an OTP waiting on sandbox verification"""
+    return PENDING_PREFIX + phone_number.encode()
+
+
+def acquire_send_slot(phone_number):
+    """Claim the per-number OTP send slot with SET NX EX; False if rate limited"""
+    key = RATE_LIMIT_PREFIX + phone_number.encode()
+    return bool(redis_client.set(key, 1, ex=RATE_LIMIT_WINDOW, nx=True))
+
+
+def claim_and_store_otp(phone_number, otp):
+    """Claim the send slot and store the active OTP in one round-trip; False if rate limited"""
+    keys = [RATE_LIMIT_PREFIX + phone_number.encode(), otp_key(phone_number)]
+    return CLAIM_AND_STORE_OTP_LUA(keys=keys, args=[otp, 300, RATE_LIMIT_WINDOW]) == 1
+
+
+def release_send_slot(phone_number):
+    """Free the send slot so a failed send doesn't lock the number out"""
+    redis_client.delete(RATE_LIMIT_PREFIX + phone_number.encode())
+
+
+def rate_limited_response():
+    """429 response for numbers still inside their rate-limit window"""
+    return jsonify({
+        "status": "error",
+        "message": "Too many OTP requests. Please try again later."
+    }), 429, {"Retry-After": str(RATE_LIMIT_WINDOW)}
+
+
+def generate_otp():
+    """Generate a 6-digit OTP from a CSPRNG"""
+    return f"{secrets.randbelow(900000) + 100000:06d}"
 
 
 def send_sandbox_verification(phone_number):
     """Send AWS SNS sandbox verification to a new number"""
     try:
-        response = sns_client.create_sms_sandbox_phone_number(
+        sns_client.create_sms_sandbox_phone_number(
             PhoneNumber=phone_number,
             LanguageCode='en-US'
         )
@@ -75,7 +271,7 @@ def send_sandbox_verification(phone_number):
 def verify_sandbox_number(phone_number, verification_code):
     """Verify sandbox number with AWS verification code"""
     try:
-        response = sns_client.verify_sms_sandbox_phone_number(
+        sns_client.verify_sms_sandbox_phone_number(
             PhoneNumber=phone_number,
             OneTimePassword=verification_code
         )
@@ -87,18 +283,13 @@ def verify_sandbox_number(phone_number, verification_code):
         return False
 
 
-def send_otp_sms(phone_number, otp):
+def publish_otp_sms(phone_number, otp):
     """Send OTP via AWS SNS with proper error handling"""
     try:
         response = sns_client.publish(
             PhoneNumber=phone_number,
-            Message=f"Your verification code is: {otp}",
-            MessageAttributes={
-                'AWS.SNS.SMS.SMSType': {
-                    'DataType': 'String',
-                    'StringValue': 'Transactional'
-                }
-            }
+            Message=SMS_MESSAGE_PREFIX + otp,
+            MessageAttributes=SMS_ATTRIBUTES
         )
         return {"success": True, "message_id": response.get('MessageId')}
     except ClientError as e:
@@ -113,43 +304,140 @@ def send_otp_sms(phone_number, otp):
             return {"success": False, "error": "aws_error", "message": str(e)}
 
 
+def handle_sms_result(phone_number, future, track_verification=True):
+    """Record the outcome of a background OTP publish
+
+    Topic publishes pass track_verification=False: SNS accepting a topic
+    message says nothing about whether the phone can receive it.
+    """
+    if future.exception():
+        logger.error(f"Failed to send OTP to {phone_number}: {str(future.exception())}")
+        return
+
+    sms_result = future.result()
+    if not track_verification:
+        if not sms_result["success"]:
+            logger.error(f"Failed to send OTP to {phone_number}: {sms_result['message']}")
+    elif sms_result["success"]:
+        mark_number_as_verified(phone_number)  # Mark as verified for future use
+    elif sms_result["error"] == "unverified_number":
+        # Next /send-otp for this number goes through sandbox verification,
+        # so don't leave it waiting out the rate-limit window
+        mark_number_as_unverified(phone_number)
+        release_send_slot(phone_number)
+        logger.warning(f"Number not verified in sandbox: {phone_number}")
+    else:
+        logger.error(f"Failed to send OTP to {phone_number}: {sms_result['message']}")
+
+
+def drain_queue(queue, max_items, max_wait):
+    """Block for one item, then collect up to max_items within max_wait seconds"""
+    items = [queue.get()]
+    deadline = time.monotonic() + max_wait
+    while len(items) < max_items:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            items.append(queue.get(timeout=remaining))
+        except Empty:
+            break
+    return items
+
+
+def publish_batch_worker():
+    """Drain OUTBOX and publish queued OTPs to the SNS topic in batches"""
+    while True:
+        batch = drain_queue(OUTBOX, SNS_BATCH_SIZE, SNS_BATCH_WAIT)
+        futures = {}
+        entries = []
+        for index, (phone_number, otp, future) in enumerate(batch):
+            entry_id = str(index)
+            futures[entry_id] = future
+            entries.append({
+                'Id': entry_id,
+                'Message': SMS_MESSAGE_PREFIX + otp,
+                'MessageAttributes': {
+                    **SMS_ATTRIBUTES,
+                    'phone_number': {
+                        'DataType': 'String',
+                        'StringValue': phone_number
+                    }
+                }
+            })
+
+        try:
+            response = sns_client.publish_batch(
+                TopicArn=SNS_TOPIC_ARN,
+                PublishBatchRequestEntries=entries
+            )
+        except Exception as e:
+            for future in futures.values():
+                future.set_exception(e)
+            continue
+
+        for entry in response.get('Successful', []):
+            futures[entry['Id']].set_result({"success": True, "message_id": entry.get('MessageId')})
+        for entry in response.get('Failed', []):
+            futures[entry['Id']].set_result({
+                "success": False,
+                "error": "aws_error",
+                "message": entry.get('Message', entry['Code'])
+            })
+
+
+def send_otp_sms(phone_number, otp):
+    """Queue an OTP SMS for background delivery and return its Future"""
+    if SNS_TOPIC_ARN:
+        future = Future()
+        try:
+            OUTBOX.put_nowait((phone_number, otp, future))
+        except Full:
+            # Flusher is backed up; publish directly rather than block the request.
+            # Still topic mode, so the result doesn't feed the sandbox bookkeeping.
+            logger.warning(f"SNS batch queue full, publishing OTP to {phone_number} directly")
+            future = EXECUTOR.submit(publish_otp_sms, phone_number, otp)
+        future.add_done_callback(lambda f: handle_sms_result(phone_number, f, track_verification=False))
+        return future
+
+    future = EXECUTOR.submit(publish_otp_sms, phone_number, otp)
+    future.add_done_callback(lambda f: handle_sms_result(phone_number, f))
+    return future
+
+
+if SNS_TOPIC_ARN:
+    threading.Thread(target=publish_batch_worker, name="sns-publish-batch", daemon=True).start()
+
+
 @app.route('/send-otp', methods=['POST'])
 def send_otp():
-    data = request.json
+    data = get_request_json()
     phone_number = data.get('phone_number')
 
     if not phone_number:
         return jsonify({"status": "error", "message": "Missing phone number"}), 400
 
-    # Ensure phone number has +91 prefix
-    if not phone_number.startswith('+91'):
-        phone_number = '+91' + phone_number.lstrip('0')
+    phone_number = normalize_phone(phone_number)
 
     try:
         # Generate a 6-digit OTP
-        otp = f"{random.randint(100000, 999999)}"
-
-        # Check if number is verified or try to send OTP directly
-        sms_result = send_otp_sms(phone_number, otp)
+        otp = generate_otp()
 
-        if sms_result["success"]:
-            # OTP sent successfully
-            redis_client.setex(f"otp:{phone_number}", 300, otp)
-            mark_number_as_verified(phone_number)  # Mark as verified for future use
+        if is_number_unverified(phone_number):
+            # The sandbox verification SMS shares the per-number send slot
+            if not acquire_send_slot(phone_number):
+                return rate_limited_response()
 
-            return jsonify({
-                "status": "success",
-                "otp_sent_to": phone_number,
-                "message_id": sms_result.get("message_id")
-            })
-
-        elif sms_result["error"] == "unverified_number":
             # Number needs verification in sandbox
-            verification_sent = send_sandbox_verification(phone_number)
+            try:
+                verification_sent = send_sandbox_verification(phone_number)
+            except Exception:
+                release_send_slot(phone_number)
+                raise
 
             if verification_sent:
                 # Store the OTP for later use after verification
-                redis_client.setex(f"pending_otp:{phone_number}", 600, otp)
+                redis_client.set(pending_otp_key(phone_number), otp, ex=600)
 
                 return jsonify({
                     "status": "verification_required",
@@ -158,17 +446,26 @@ def send_otp():
                     "action": "verify_number"
                 }), 202
             else:
+                release_send_slot(phone_number)
                 return jsonify({
                     "status": "error",
                     "message": "Failed to send verification SMS"
                 }), 500
 
-        else:
-            # Other SMS errors
-            return jsonify({
-                "status": "error",
-                "message": sms_result["message"]
-            }), 400
+        # Claim the send slot and store the OTP, then hand the SMS off
+        if not claim_and_store_otp(phone_number, otp):
+            return rate_limited_response()
+
+        try:
+            send_otp_sms(phone_number, otp)
+        except Exception:
+            release_send_slot(phone_number)
+            raise
+
+        return jsonify({
+            "status": "success",
+            "otp_sent_to": phone_number
+        }), 202
 
     except Exception as e:
         logger.error(f"Unexpected error: {str(e)}")
@@ -178,7 +475,7 @@ def send_otp():
 @app.route('/verify-number', methods=['POST'])
 def verify_number():
     """Verify a new number with AWS sandbox verification code"""
-    data = request.json
+    data = get_request_json()
     phone_number = data.get('phone_number')
     verification_code = data.get('verification_code')
 
@@ -188,30 +485,29 @@ def verify_number():
             "message": "Missing phone number or verification code"
         }), 400
 
-    # Ensure phone number has +91 prefix
-    if not phone_number.startswith('+91'):
-        phone_number = '+91' + phone_number.lstrip('0')
+    phone_number = normalize_phone(phone_number)
 
     try:
         if verify_sandbox_number(phone_number, verification_code):
-            # Number verified, now check if there's a pending OTP to send
-            pending_otp = redis_client.get(f"pending_otp:{phone_number}")
-
-            if pending_otp:
-                # Send the pending OTP
+            # Number verified, now claim the pending OTP (if any) atomically
+            # so concurrent verifications can't both send it
+            pipe = redis_client.pipeline(transaction=True)
+            pending_key = pending_otp_key(phone_number)
+            pipe.get(pending_key)
+            pipe.delete(pending_key)
+            pending_otp, claimed = pipe.execute()
+
+            if pending_otp and claimed:
+                # Move from pending to active OTP, then send it
                 otp = pending_otp.decode()
-                sms_result = send_otp_sms(phone_number, otp)
-
-                if sms_result["success"]:
-                    # Move from pending to active OTP
-                    redis_client.delete(f"pending_otp:{phone_number}")
-                    redis_client.setex(f"otp:{phone_number}", 300, otp)
+                redis_client.set(otp_key(phone_number), otp, ex=300)
+                send_otp_sms(phone_number, otp)
 
-                    return jsonify({
-                        "status": "success",
-                        "message": "Number verified and OTP sent successfully",
-                        "otp_sent_to": phone_number
-                    })
+                return jsonify({
+                    "status": "success",
+                    "message": "Number verified and OTP sent successfully",
+                    "otp_sent_to": phone_number
+                }), 202
 
             return jsonify({
                 "status": "success",
@@ -231,26 +527,22 @@ def verify_number():
 
 @app.route('/verify-otp', methods=['POST'])
 def verify_otp():
-    data = request.json
+    data = get_request_json()
     phone_number = data.get('phone_number')
     submitted_otp = data.get('otp')
 
     if not phone_number or not submitted_otp:
         return jsonify({"status": "error", "message": "Missing phone number or OTP"}), 400
 
-    # Ensure phone number has +91 prefix
-    if not phone_number.startswith('+91'):
-        phone_number = '+91' + phone_number.lstrip('0')
+    phone_number = normalize_phone(phone_number)
 
     try:
-        otp_key = f"otp:{phone_number}"
-        stored_otp = redis_client.get(otp_key)
+        result = VERIFY_OTP_LUA(keys=[otp_key(phone_number)], args=[str(submitted_otp)])
 
-        if stored_otp is None:
+        if result == 0:
             return jsonify({"status": "error", "message": "OTP expired or not found"}), 404
 
-        if stored_otp.decode() == submitted_otp:
-            redis_client.delete(otp_key)
+        if result == 1:
             return jsonify({"status": "success", "message": "OTP verified successfully"})
         else:
             return jsonify({"status": "error", "message": "Invalid OTP"}), 401
@@ -263,18 +555,17 @@ def verify_otp():
 @app.route('/resend-otp', methods=['POST'])
 def resend_otp():
     """Resend OTP for verified numbers"""
-    data = request.json
+    data = get_request_json()
     phone_number = data.get('phone_number')
 
     if not phone_number:
         return jsonify({"status": "error", "message": "Missing phone number"}), 400
 
-    # Ensure phone number has +91 prefix
-    if not phone_number.startswith('+91'):
-        phone_number = '+91' + phone_number.lstrip('0')
+    phone_number = normalize_phone(phone_number)
 
-    # Check if number is verified
-    if not is_number_verified(phone_number):
+    # Check if number is verified. Topic sends can't verify numbers, so
+    # topic mode relies on the rate limit alone.
+    if not SNS_TOPIC_ARN and not is_number_verified(phone_number):
         return jsonify({
             "status": "error",
             "message": "Number not verified. Please verify first."
@@ -282,27 +573,31 @@ def resend_otp():
 
     try:
         # Generate new OTP
-        otp = f"{random.randint(100000, 999999)}"
+        otp = generate_otp()
 
-        # Send OTP
-        sms_result = send_otp_sms(phone_number, otp)
+        # Claim the send slot and store the OTP, then send it in the background
+        if not claim_and_store_otp(phone_number, otp):
+            return rate_limited_response()
 
-        if sms_result["success"]:
-            redis_client.setex(f"otp:{phone_number}", 300, otp)
-            return jsonify({
-                "status": "success",
-                "otp_sent_to": phone_number,
-                "message": "OTP resent successfully"
-            })
-        else:
-            return jsonify({
-                "status": "error",
-                "message": sms_result["message"]
-            }), 400
+        try:
+            send_otp_sms(phone_number, otp)
+        except Exception:
+            release_send_slot(phone_number)
+            raise
+
+        return jsonify({
+            "status": "success",
+            "otp_sent_to": phone_number,
+            "message": "OTP resent successfully"
+        }), 202
 
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # Development server only; production runs under gunicorn (gunicorn_config.py)
+    if os.getenv("FLASK_DEV") == "1":
+        app.run(debug=True, threaded=True)
+    else:
+        logger.error("Set FLASK_DEV=1 to use the development server, or run: gunicorn -c gunicorn_config.py app:app")
@@ -1,2 +1,9 @@
-bind = "0.0.0.0:$PORT"
-workers = 2
\ No newline at end of file
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", 2 * multiprocessing.cpu_count() + 1))
+worker_class = "gthread"
+# Per worker; keep the Redis pool (64) above threads + SNS executor (32)
+threads = 16
+keepalive = 30